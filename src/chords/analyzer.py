@@ -10,6 +10,14 @@ from typing import List, Tuple
 import librosa
 import numpy as np
 
+# 檢查 torchaudio 是否可用（GPU 色度圖計算）
+try:
+    import torch
+    import torchaudio  # noqa: F401
+    _TORCHAUDIO_AVAILABLE = True
+except Exception:
+    _TORCHAUDIO_AVAILABLE = False
+
 # 大調音階的半音間隔模式
 MAJOR_SCALE_INTERVALS = [0, 2, 4, 5, 7, 9, 11]
 
@@ -19,6 +27,16 @@ MINOR_SCALE_INTERVALS = [0, 2, 3, 5, 7, 8, 10]
 # 音符名稱
 NOTE_NAMES = ["C", "C#", "D", "D#", "E", "F", "F#", "G", "G#", "A", "A#", "B"]
 
+# 色度圖參數（CPU 與 GPU 路徑共用，確保兩邊的調性結果一致）
+_CHROMA_SAMPLE_RATE = 22050
+_CHROMA_N_FFT = 4096
+_CHROMA_HOP_LENGTH = 4096
+
+# 三度音程查表：列 0 為大調、列 1 為小調，欄為旋律音相對根音的半音距離
+_THIRD_LUT = np.full((2, 12), 3, dtype=np.int8)
+_THIRD_LUT[0, [0, 5, 7]] = 4    # 大調：I、IV、V 級是大三度
+_THIRD_LUT[1, [3, 8, 10]] = 4   # 小調：III、VI、VII 級是大三度
+
 
 @dataclass
 class KeyInfo:
@@ -46,37 +64,38 @@ def analyze_key(
     """
     print("正在分析調性...")
 
-    # 確保音訊為單聲道
+    # 確保音訊為單聲道（指定 dtype 避免悄悄升成 float64）
     if audio.ndim == 2:
-        audio_mono = np.mean(audio, axis=0)
+        audio_mono = np.mean(audio, axis=0, dtype=np.float32)
     else:
-        audio_mono = audio
+        audio_mono = audio.astype(np.float32, copy=False)
 
-    # 計算色度圖（Chromagram）
-    chroma = librosa.feature.chroma_cqt(y=audio_mono, sr=sample_rate)
+    # 計算色度圖
+    # 有 CUDA 時在 GPU 上計算（FFT 為主的工作量），否則 fallback 到 librosa
+    chroma = None
+    if _TORCHAUDIO_AVAILABLE and torch.cuda.is_available():
+        try:
+            chroma = _compute_chroma_gpu(audio_mono, sample_rate)
+        except Exception:
+            chroma = None
 
-    # 計算每個音高類別的平均能量
-    chroma_mean = np.mean(chroma, axis=1)
+    if chroma is None:
+        chroma = _compute_chroma_cpu(audio_mono, sample_rate)
+
+    # 計算每個音高類別的平均能量（兩條路徑共用同一個正規化與平均）
+    chroma_mean = _normalized_chroma_mean(chroma)
 
     # 嘗試所有可能的大調和小調，找出最匹配的
-    best_score = -1
-    best_key = 0
-    best_mode = "major"
-
-    for root in range(12):
-        # 計算大調分數
-        major_score = _calculate_key_score(chroma_mean, root, MAJOR_SCALE_INTERVALS)
-        if major_score > best_score:
-            best_score = major_score
-            best_key = root
-            best_mode = "major"
-
-        # 計算小調分數
-        minor_score = _calculate_key_score(chroma_mean, root, MINOR_SCALE_INTERVALS)
-        if minor_score > best_score:
-            best_score = minor_score
-            best_key = root
-            best_mode = "minor"
+    # 12x12 循環矩陣：第 r 列是向左捲動 r 格的 chroma，
+    # fancy-index 取音階位置後沿軸加總，一次算出全部 24 個分數
+    rolled = np.stack([np.roll(chroma_mean, -r) for r in range(12)])
+    major_scores = rolled[:, MAJOR_SCALE_INTERVALS].sum(axis=1)
+    minor_scores = rolled[:, MINOR_SCALE_INTERVALS].sum(axis=1)
+    scores = np.concatenate([major_scores, minor_scores])
+    best = int(np.argmax(scores))
+    best_score = float(scores[best])
+    best_key = best % 12
+    best_mode = "major" if best < 12 else "minor"
 
     # 計算信心度（正規化分數）
     confidence = best_score / np.sum(chroma_mean)
@@ -98,17 +117,71 @@ def analyze_key(
     )
 
 
-def _calculate_key_score(
-    chroma_mean: np.ndarray,
-    root: int,
-    intervals: List[int]
-) -> float:
-    """計算特定調性的匹配分數"""
-    score = 0.0
-    for interval in intervals:
-        note_index = (root + interval) % 12
-        score += chroma_mean[note_index]
-    return score
+def _normalized_chroma_mean(chroma: np.ndarray) -> np.ndarray:
+    """以 CENS 式逐框 L1 正規化後取時間平均
+
+    每個時間框等權重，響度高的段落才不會主導整曲的平均色度。
+    """
+    chroma = chroma.astype(np.float32, copy=False)
+    frame_norms = chroma.sum(axis=0, keepdims=True)
+    np.clip(frame_norms, 1e-10, None, out=frame_norms)
+    chroma = chroma / frame_norms
+    return np.mean(chroma, axis=1, dtype=np.float32)
+
+
+def _compute_chroma_cpu(
+    audio_mono: np.ndarray,
+    sample_rate: int
+) -> np.ndarray:
+    """在 CPU 上以 librosa 計算 (12, n_frames) 色度矩陣"""
+    # 調性偵測不需要 10 kHz 以上的內容，先降取樣減少 FFT 計算量
+    if sample_rate > _CHROMA_SAMPLE_RATE:
+        audio_mono = librosa.resample(
+            audio_mono, orig_sr=sample_rate, target_sr=_CHROMA_SAMPLE_RATE
+        )
+        sample_rate = _CHROMA_SAMPLE_RATE
+
+    # 全曲調性只需要時間平均的色度，STFT 版本比 CQT 便宜 5-10 倍；
+    # hop 加大到 4096 讓色度矩陣的時間軸早點抽稀、記憶體減半
+    return librosa.feature.chroma_stft(
+        y=audio_mono,
+        sr=sample_rate,
+        n_fft=_CHROMA_N_FFT,
+        hop_length=_CHROMA_HOP_LENGTH,
+        tuning=0
+    )
+
+
+def _compute_chroma_gpu(
+    audio_mono: np.ndarray,
+    sample_rate: int
+) -> np.ndarray:
+    """在 GPU 上以 torchaudio 計算 (12, n_frames) 色度矩陣
+
+    與 CPU 路徑使用相同的取樣率與 FFT/hop 參數，
+    結果交給同一個 _normalized_chroma_mean 做正規化與平均。
+    """
+    from torchaudio.prototype.transforms import ChromaSpectrogram
+
+    with torch.no_grad():
+        audio_tensor = torch.from_numpy(audio_mono).float().cuda().unsqueeze(0)
+
+        if sample_rate > _CHROMA_SAMPLE_RATE:
+            resampler = torchaudio.transforms.Resample(
+                sample_rate, _CHROMA_SAMPLE_RATE
+            ).cuda()
+            audio_tensor = resampler(audio_tensor)
+            sample_rate = _CHROMA_SAMPLE_RATE
+
+        transform = ChromaSpectrogram(
+            sample_rate=sample_rate,
+            n_fft=_CHROMA_N_FFT,
+            hop_length=_CHROMA_HOP_LENGTH,
+            n_chroma=12
+        ).cuda()
+        chroma = transform(audio_tensor)
+
+    return chroma.squeeze(0).cpu().numpy()
 
 
 def get_harmony_intervals(
@@ -131,26 +204,36 @@ def get_harmony_intervals(
         # 五度永遠是 7 個半音
         return 7
 
-    # 三度需要根據調性判斷是大三度（4半音）還是小三度（3半音）
-    # 計算旋律音在音階中的位置
-    melody_note = melody_midi % 12
-    root = key_info.root_index
-
-    # 計算相對於根音的半音距離
-    relative_semitones = (melody_note - root) % 12
-
-    # 根據調性判斷三度類型
-    if key_info.mode == "major":
-        # 大調：1、4、5 級是大三度，其他是小三度
-        major_third_positions = [0, 5, 7]  # I, IV, V
-        if relative_semitones in major_third_positions:
-            return 4  # 大三度
-        else:
-            return 3  # 小三度
-    else:
-        # 小調：3、6、7 級是大三度，其他是小三度
-        major_third_positions = [3, 8, 10]  # III, VI, VII
-        if relative_semitones in major_third_positions:
-            return 4  # 大三度
-        else:
-            return 3  # 小三度
+    # 三度需要根據調性判斷是大三度（4半音）還是小三度（3半音），
+    # 直接以查表取代逐音的串列比對
+    mode_row = 0 if key_info.mode == "major" else 1
+    relative_semitones = (melody_midi - key_info.root_index) % 12
+    return int(_THIRD_LUT[mode_row, relative_semitones])
+
+
+def get_harmony_intervals_array(
+    key_info: KeyInfo,
+    melody_midi: np.ndarray,
+    harmony_type: str = "third"
+) -> np.ndarray:
+    """
+    get_harmony_intervals 的向量化版本，一次處理整段 MIDI 音符序列
+
+    參數:
+        key_info: 調性資訊
+        melody_midi: 旋律音的 MIDI 編號陣列（可為浮點數，會四捨五入）
+        harmony_type: 和聲類型，"third"（三度）或 "fifth"（五度）
+
+    回傳:
+        與輸入同形狀的半音數陣列
+    """
+    melody_midi = np.asarray(melody_midi)
+
+    if harmony_type == "fifth":
+        return np.full(melody_midi.shape, 7, dtype=np.int8)
+
+    mode_row = 0 if key_info.mode == "major" else 1
+    relative_semitones = (
+        np.rint(melody_midi).astype(np.int64) - key_info.root_index
+    ) % 12
+    return _THIRD_LUT[mode_row, relative_semitones]
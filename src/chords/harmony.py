@@ -4,27 +4,47 @@
 使用 pyrubberband 或 librosa 進行變調，生成和聲
 """
 
+import hashlib
+import importlib.util
+import multiprocessing
+import os
+import subprocess
+import tempfile
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
 from dataclasses import dataclass
-from typing import List, Optional
+from multiprocessing import shared_memory
+from typing import List, Optional, Tuple
 
+import librosa
 import numpy as np
 
 from .analyzer import KeyInfo, get_harmony_intervals
 from .pitch import PitchData, frequency_to_midi
 
 
-# 檢查 rubberband 是否可用
-_USE_RUBBERBAND = False
-try:
-    import pyrubberband as pyrb
-    # 測試 rubberband 是否真的可以運作
-    _test_audio = np.zeros(1000, dtype=np.float32)
-    pyrb.pitch_shift(_test_audio, 44100, 1)
-    _USE_RUBBERBAND = True
-    print("使用 pyrubberband 進行高品質變調")
-except Exception:
-    print("pyrubberband 不可用，改用 librosa（品質稍低但仍可接受）")
-    import librosa
+# rubberband 可用性採延遲偵測：None 表示尚未檢查
+# （在 import 時實際執行一次變調會讓每次載入模組都多花數百毫秒）
+_USE_RUBBERBAND = None
+
+
+def _use_rubberband() -> bool:
+    """第一次呼叫時檢查 pyrubberband 是否已安裝（不實際執行變調）"""
+    global _USE_RUBBERBAND
+    if _USE_RUBBERBAND is None:
+        if importlib.util.find_spec("pyrubberband") is not None:
+            _USE_RUBBERBAND = True
+            print("使用 pyrubberband 進行高品質變調")
+        else:
+            _USE_RUBBERBAND = False
+            print("pyrubberband 不可用，改用 librosa（品質稍低但仍可接受）")
+    return _USE_RUBBERBAND
+
+
+def _mark_rubberband_broken() -> None:
+    """記錄 rubberband 實際執行失敗，之後的變調直接改用 librosa"""
+    global _USE_RUBBERBAND
+    _USE_RUBBERBAND = False
 
 
 @dataclass
@@ -36,17 +56,31 @@ class HarmonyTrack:
 
 
 def _pitch_shift_rubberband(audio: np.ndarray, sample_rate: int, semitones: int) -> np.ndarray:
-    """使用 pyrubberband 變調"""
-    return pyrb.pitch_shift(
-        audio,
-        sample_rate,
-        semitones,
-        rbargs={"--fine": "", "--formant": ""}  # 保留共振峰
-    )
+    """使用 pyrubberband 變調（立體聲以單一 Rubberband 實例一次處理）"""
+    import pyrubberband as pyrb
+
+    rbargs = {"--fine": "", "--formant": ""}  # 保留共振峰
+
+    if audio.ndim == 2:
+        # pyrubberband 原生支援多聲道（需要 (samples, channels) 格式），
+        # 一次呼叫即可分析所有聲道，避免每個聲道重跑分析
+        shifted = pyrb.pitch_shift(audio.T, sample_rate, semitones, rbargs=rbargs)
+        return shifted.T
+
+    return pyrb.pitch_shift(audio, sample_rate, semitones, rbargs=rbargs)
 
 
 def _pitch_shift_librosa(audio: np.ndarray, sample_rate: int, semitones: int) -> np.ndarray:
     """使用 librosa 變調"""
+    if audio.ndim == 2:
+        # librosa 需逐聲道處理；安裝 rubberband 可一次處理整個立體聲
+        print("提示: 安裝 rubberband 可加速立體聲變調")
+        shifted = [
+            librosa.effects.pitch_shift(y=audio[ch], sr=sample_rate, n_steps=semitones)
+            for ch in range(audio.shape[0])
+        ]
+        return np.stack(shifted, axis=0)
+
     return librosa.effects.pitch_shift(
         y=audio,
         sr=sample_rate,
@@ -54,12 +88,162 @@ def _pitch_shift_librosa(audio: np.ndarray, sample_rate: int, semitones: int) ->
     )
 
 
+# 變調結果磁碟快取（以 CHORDS_PITCH_CACHE=1 啟用，避免使用者意外吃磁碟）
+_PITCH_CACHE_ENV = "CHORDS_PITCH_CACHE"
+_PITCH_CACHE_DIR = Path.home() / ".cache" / "chords" / "pitchshift"
+
+
+def _pitch_cache_path(audio: np.ndarray, sample_rate: int, semitones: int) -> Path:
+    """以音訊內容 + 參數的 SHA-256 作為快取檔名"""
+    digest = hashlib.sha256()
+    digest.update(np.ascontiguousarray(audio).tobytes())
+    digest.update(
+        f"{audio.shape}|{audio.dtype}|{sample_rate}|{semitones}".encode()
+    )
+    return _PITCH_CACHE_DIR / f"{digest.hexdigest()}.npy"
+
+
+def _pitch_cache_enabled() -> bool:
+    """磁碟快取是否已以環境變數啟用"""
+    return os.environ.get(_PITCH_CACHE_ENV) == "1"
+
+
+def _pitch_cache_load(cache_path: Path) -> Optional[np.ndarray]:
+    """讀取快取的變調結果，不存在或毀損時回傳 None"""
+    if cache_path.exists():
+        try:
+            return np.load(cache_path)
+        except Exception:
+            pass
+    return None
+
+
+def _pitch_cache_store(cache_path: Path, result: np.ndarray) -> None:
+    """寫入變調結果到快取（寫入失敗不影響主流程）"""
+    try:
+        _PITCH_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        np.save(cache_path, result.astype(np.float32, copy=False))
+    except OSError:
+        pass
+
+
 def _pitch_shift(audio: np.ndarray, sample_rate: int, semitones: int) -> np.ndarray:
+    """變調入口：視環境變數決定是否走磁碟快取"""
+    if not _pitch_cache_enabled():
+        return _pitch_shift_uncached(audio, sample_rate, semitones)
+
+    # 同一段音訊、同參數的變調在重複執行（例如只調 --harmony-volume
+    # 的開發迴圈）時直接從快取載入，省下整段 rubberband 運算
+    cache_path = _pitch_cache_path(audio, sample_rate, semitones)
+    cached = _pitch_cache_load(cache_path)
+    if cached is not None:
+        return cached
+
+    result = _pitch_shift_uncached(audio, sample_rate, semitones)
+    _pitch_cache_store(cache_path, result)
+    return result
+
+
+def _pitch_shift_uncached(audio: np.ndarray, sample_rate: int, semitones: int) -> np.ndarray:
     """選擇可用的變調方法"""
-    if _USE_RUBBERBAND:
-        return _pitch_shift_rubberband(audio, sample_rate, semitones)
-    else:
-        return _pitch_shift_librosa(audio, sample_rate, semitones)
+    if _use_rubberband():
+        try:
+            return _pitch_shift_rubberband(audio, sample_rate, semitones)
+        except Exception:
+            # 套件裝了但 rubberband 執行檔缺失等情況：記錄後改走 librosa
+            _mark_rubberband_broken()
+            print("pyrubberband 執行失敗，改用 librosa（品質稍低但仍可接受）")
+    return _pitch_shift_librosa(audio, sample_rate, semitones)
+
+
+class _BatchPitchShifter:
+    """對同一段人聲連續做多次變調的批次變調器
+
+    pyrubberband 每次呼叫都會把輸入音訊重新寫入暫存 WAV 再執行
+    rubberband 程式。此類別只寫入一次輸入檔，之後每個半音數各執行
+    一次 rubberband；結果以半音數為鍵快取，重複的半音數不會重算。
+    """
+
+    def __init__(self, vocals: np.ndarray, sample_rate: int):
+        self._vocals = vocals
+        self._sample_rate = sample_rate
+        self._cache = {}
+        self._input_path = None
+
+    def shift(self, semitones: int) -> np.ndarray:
+        """變調指定半音數，相同半音數直接回傳快取結果"""
+        if semitones in self._cache:
+            return self._cache[semitones]
+
+        # 磁碟快取啟用時先查快取，命中就完全跳過 rubberband
+        cache_path = None
+        if _pitch_cache_enabled():
+            cache_path = _pitch_cache_path(
+                self._vocals, self._sample_rate, semitones
+            )
+            cached = _pitch_cache_load(cache_path)
+            if cached is not None:
+                self._cache[semitones] = cached
+                return cached
+
+        result = None
+        if _use_rubberband():
+            try:
+                result = self._shift_shared_input(semitones)
+            except Exception:
+                result = None
+
+        if result is None:
+            result = _pitch_shift_uncached(
+                self._vocals, self._sample_rate, semitones
+            )
+
+        if cache_path is not None:
+            _pitch_cache_store(cache_path, result)
+
+        self._cache[semitones] = result
+        return result
+
+    def _shift_shared_input(self, semitones: int) -> np.ndarray:
+        """以共用的輸入暫存檔執行 rubberband"""
+        import soundfile as sf
+
+        if self._input_path is None:
+            fd, path = tempfile.mkstemp(suffix=".wav")
+            os.close(fd)
+            data = self._vocals.T if self._vocals.ndim == 2 else self._vocals
+            sf.write(path, data, self._sample_rate)
+            self._input_path = path
+
+        fd, output_path = tempfile.mkstemp(suffix=".wav")
+        os.close(fd)
+        try:
+            subprocess.check_call(
+                [
+                    "rubberband",
+                    "--pitch", str(semitones),
+                    "--fine",
+                    "--formant",
+                    self._input_path,
+                    output_path,
+                ],
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            )
+            shifted, _ = sf.read(output_path, dtype="float32")
+        finally:
+            os.remove(output_path)
+
+        return shifted.T if self._vocals.ndim == 2 else shifted
+
+    def close(self) -> None:
+        """清除共用的輸入暫存檔"""
+        if self._input_path is not None:
+            try:
+                os.remove(self._input_path)
+            except OSError:
+                pass
+            self._input_path = None
 
 
 def generate_harmony(
@@ -82,17 +266,8 @@ def generate_harmony(
     """
     print(f"生成 {harmony_type} 和聲（變調 {semitones:+d} 半音）...")
 
-    # 處理立體聲
-    if vocals.ndim == 2:
-        # 分別處理每個聲道
-        harmony_channels = []
-        for ch in range(vocals.shape[0]):
-            shifted = _pitch_shift(vocals[ch], sample_rate, semitones)
-            harmony_channels.append(shifted)
-        harmony_audio = np.stack(harmony_channels, axis=0)
-    else:
-        # 單聲道
-        harmony_audio = _pitch_shift(vocals, sample_rate, semitones)
+    # 立體聲與單聲道皆由變調函式一次處理
+    harmony_audio = _pitch_shift(vocals, sample_rate, semitones)
 
     return HarmonyTrack(
         audio=harmony_audio,
@@ -166,8 +341,8 @@ def generate_multi_harmony(
         octave_shift = 12   # 升八度
         print("使用女聲模式（升八度）")
 
-    harmonies = []
-
+    # 先算出所有 (半音數, 類型) 組合，再一次批次變調
+    shift_plan = []
     for harmony_type in harmony_types:
         if harmony_type == "fifth":
             semitones = 7
@@ -190,9 +365,84 @@ def generate_multi_harmony(
             continue
 
         # 加上八度偏移
-        semitones += octave_shift
+        shift_plan.append((semitones + octave_shift, harmony_type))
+
+    # 各和聲彼此獨立且為 CPU 密集，多於一個時以行程池平行生成
+    if len(shift_plan) > 1 and (os.cpu_count() or 1) > 1:
+        try:
+            return _generate_harmonies_parallel(vocals, sample_rate, shift_plan)
+        except Exception:
+            print("平行生成和聲失敗，改用逐一生成")
 
-        harmony = generate_harmony(vocals, sample_rate, semitones, harmony_type)
-        harmonies.append(harmony)
+    # 共用同一個批次變調器，輸入音訊只寫入暫存檔一次
+    harmonies = []
+    shifter = _BatchPitchShifter(vocals, sample_rate)
+    try:
+        for semitones, harmony_type in shift_plan:
+            print(f"生成 {harmony_type} 和聲（變調 {semitones:+d} 半音）...")
+            harmonies.append(HarmonyTrack(
+                audio=shifter.shift(semitones),
+                harmony_type=harmony_type,
+                semitones=semitones
+            ))
+    finally:
+        shifter.close()
 
     return harmonies
+
+
+def _generate_harmonies_parallel(
+    vocals: np.ndarray,
+    sample_rate: int,
+    shift_plan: List[Tuple[int, str]]
+) -> List[HarmonyTrack]:
+    """以行程池平行生成多個和聲
+
+    人聲波形放入共享記憶體，避免每個 worker 都 pickle 一份完整音訊。
+    """
+    shm = shared_memory.SharedMemory(create=True, size=vocals.nbytes)
+    try:
+        shm_view = np.ndarray(vocals.shape, dtype=vocals.dtype, buffer=shm.buf)
+        shm_view[:] = vocals
+
+        max_workers = min(len(shift_plan), os.cpu_count() or 1)
+        # 一定要用 spawn：此時父行程可能已初始化 torch/CUDA 與 TensorFlow
+        # 執行緒池，fork 這種行程容易卡死；共享記憶體已避免 fork 省下的
+        # pickle 成本，spawn 沒有額外代價
+        mp_context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(
+            max_workers=max_workers, mp_context=mp_context
+        ) as executor:
+            futures = [
+                executor.submit(
+                    _generate_harmony_from_shm,
+                    shm.name,
+                    vocals.shape,
+                    vocals.dtype.str,
+                    sample_rate,
+                    semitones,
+                    harmony_type
+                )
+                for semitones, harmony_type in shift_plan
+            ]
+            return [future.result() for future in futures]
+    finally:
+        shm.close()
+        shm.unlink()
+
+
+def _generate_harmony_from_shm(
+    shm_name: str,
+    shape: Tuple[int, ...],
+    dtype_str: str,
+    sample_rate: int,
+    semitones: int,
+    harmony_type: str
+) -> HarmonyTrack:
+    """行程池 worker：從共享記憶體讀取人聲後生成單一和聲"""
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        vocals = np.ndarray(shape, dtype=np.dtype(dtype_str), buffer=shm.buf)
+        return generate_harmony(vocals, sample_rate, semitones, harmony_type)
+    finally:
+        shm.close()
@@ -8,12 +8,52 @@ from dataclasses import dataclass
 from typing import List, Optional
 
 import numpy as np
+from numba import njit, prange
 from pedalboard import Pedalboard, Reverb, Compressor, Gain
 from pedalboard.io import AudioFile
 
 from .harmony import HarmonyTrack
 
 
+@njit(cache=True, parallel=True, fastmath=True)
+def _abs_max(x: np.ndarray) -> float:
+    """單趟掃描的絕對值最大值（不配置 |x| 暫存陣列）"""
+    m = 0.0
+    for i in prange(x.size):
+        v = x[i]
+        a = -v if v < 0 else v
+        m = max(m, a)
+    return m
+
+
+# 和聲效果鏈快取：以殘響參數為鍵，避免每次混音都重建 JUCE 插件
+_HARMONY_BOARD_CACHE = {}
+
+
+def _get_harmony_board(room_size: float, wet_level: float) -> Pedalboard:
+    """取得（或建立並快取）和聲用的效果鏈"""
+    key = (room_size, wet_level)
+    board = _HARMONY_BOARD_CACHE.get(key)
+    if board is None:
+        board = Pedalboard([
+            # 輕微壓縮讓和聲更穩定
+            Compressor(
+                threshold_db=-20,
+                ratio=3,
+                attack_ms=5,
+                release_ms=100
+            ),
+            # 殘響讓和聲更自然融合
+            Reverb(
+                room_size=room_size,
+                wet_level=wet_level,
+                dry_level=1.0 - wet_level
+            )
+        ])
+        _HARMONY_BOARD_CACHE[key] = board
+    return board
+
+
 @dataclass
 class MixSettings:
     """混音設定"""
@@ -50,27 +90,32 @@ def mix_audio(
 
     print("正在混音...")
 
-    # 確保所有音訊長度一致
-    min_length = min(
-        vocals.shape[-1],
-        accompaniment.shape[-1],
-        *[h.audio.shape[-1] for h in harmonies]
-    )
+    # 統一為 float32，混音階段為記憶體頻寬瓶頸，半精度寬度即可減半流量
+    vocals = vocals.astype(np.float32, copy=False)
+    accompaniment = accompaniment.astype(np.float32, copy=False)
+
+    # 確保所有音訊長度一致（逐一比較，不建立暫存串列）
+    min_length = vocals.shape[-1]
+    if accompaniment.shape[-1] < min_length:
+        min_length = accompaniment.shape[-1]
+    for harmony in harmonies:
+        if harmony.audio.shape[-1] < min_length:
+            min_length = harmony.audio.shape[-1]
 
     # 裁剪到相同長度
     vocals = vocals[..., :min_length]
     accompaniment = accompaniment[..., :min_length]
 
-    # 調整人聲音量
-    mixed = vocals * settings.vocals_volume
+    # 調整人聲音量（寫入專屬緩衝區，後續混音都在這塊記憶體原地累加）
+    mixed = np.empty_like(vocals)
+    np.multiply(vocals, settings.vocals_volume, out=mixed)
 
     # 處理和聲
     if harmonies:
-        # 合併所有和聲
+        # 合併所有和聲（原地累加，不產生暫存陣列）
         harmony_mix = np.zeros_like(mixed)
         for harmony in harmonies:
-            h_audio = harmony.audio[..., :min_length]
-            harmony_mix += h_audio
+            np.add(harmony_mix, harmony.audio[..., :min_length], out=harmony_mix)
 
         # 對和聲施加效果
         if settings.add_reverb:
@@ -81,15 +126,19 @@ def mix_audio(
             )
 
         # 加入和聲
-        mixed += harmony_mix * settings.harmony_volume
+        harmony_mix *= settings.harmony_volume
+        mixed += harmony_mix
 
-    # 加入伴奏
-    mixed += accompaniment * settings.accompaniment_volume
+    # 加入伴奏（音量為 1.0 時直接累加，避免一次全長度的暫存）
+    if settings.accompaniment_volume == 1.0:
+        mixed += accompaniment
+    else:
+        mixed += accompaniment * settings.accompaniment_volume
 
-    # 正規化以避免削波
-    max_amplitude = np.max(np.abs(mixed))
+    # 正規化以避免削波（單趟求峰值、原地縮放）
+    max_amplitude = _abs_max(mixed.ravel())
     if max_amplitude > 1.0:
-        mixed = mixed / max_amplitude * 0.95
+        mixed *= 0.95 / max_amplitude
         print(f"已正規化音訊（原始峰值: {max_amplitude:.2f}）")
 
     print("混音完成！")
@@ -112,31 +161,25 @@ def _apply_harmony_effects(
     回傳:
         處理後的和聲音訊
     """
-    # 建立效果鏈
-    board = Pedalboard([
-        # 輕微壓縮讓和聲更穩定
-        Compressor(
-            threshold_db=-20,
-            ratio=3,
-            attack_ms=5,
-            release_ms=100
-        ),
-        # 殘響讓和聲更自然融合
-        Reverb(
-            room_size=settings.reverb_room_size,
-            wet_level=settings.reverb_wet_level,
-            dry_level=1.0 - settings.reverb_wet_level
-        )
-    ])
+    # 取得快取的效果鏈（同參數重複呼叫不再重建插件）
+    board = _get_harmony_board(
+        settings.reverb_room_size,
+        settings.reverb_wet_level
+    )
 
-    # Pedalboard 需要 (samples, channels) 格式
+    # Pedalboard 需要連續的 (samples, channels) float32
     if harmony.ndim == 2:
-        harmony_transposed = harmony.T
+        harmony_transposed = np.ascontiguousarray(harmony.T, dtype=np.float32)
     else:
         harmony_transposed = harmony.reshape(-1, 1)
 
-    # 施加效果
-    processed = board(harmony_transposed, sample_rate)
+    # 施加效果（reset 清除上一次呼叫殘留的殘響尾音）
+    processed = board.process(
+        harmony_transposed,
+        sample_rate,
+        buffer_size=8192,
+        reset=True
+    )
 
     # 轉回原始格式
     if harmony.ndim == 2:
@@ -154,15 +197,16 @@ def save_audio(
     儲存音訊到檔案
 
     參數:
-        audio: 音訊陣列
+        audio: 音訊陣列，形狀為 (channels, samples) 或 (samples,)
         output_path: 輸出檔案路徑
         sample_rate: 取樣率
     """
     print(f"正在儲存音訊到: {output_path}")
 
     # Pedalboard 需要 (samples, channels) 格式
+    # 轉置後明確轉為連續記憶體，避免寫檔器內部再複製一次跨步資料
     if audio.ndim == 2:
-        audio_to_save = audio.T
+        audio_to_save = np.ascontiguousarray(audio.T)
     else:
         audio_to_save = audio.reshape(-1, 1)
 
@@ -194,7 +238,9 @@ def load_audio(input_path: str) -> tuple:
         audio = f.read(f.frames)
         sample_rate = f.samplerate
 
-    # Pedalboard 讀取的格式已經是 (channels, samples)，不需要轉置
+    # Pedalboard 讀取的格式已經是 (channels, samples)，不需要轉置；
+    # 確保為連續的 float32，下游各模組都以此佈局零複製處理
+    audio = np.ascontiguousarray(audio, dtype=np.float32)
     print(f"載入完成！取樣率: {sample_rate}, 長度: {audio.shape[-1] / sample_rate:.2f} 秒")
 
     return audio, sample_rate
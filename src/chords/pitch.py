@@ -7,8 +7,15 @@
 from dataclasses import dataclass
 from typing import Optional
 
-import crepe
+import functools
+
+import librosa
 import numpy as np
+from numba import njit, prange
+
+# CREPE 模型的固定輸入取樣率與視窗大小
+_CREPE_SAMPLE_RATE = 16000
+_CREPE_FRAME_LENGTH = 1024
 
 
 @dataclass
@@ -20,12 +27,73 @@ class PitchData:
     sample_rate: int
 
 
+@functools.lru_cache(maxsize=2)
+def _get_crepe_model(model_capacity: str):
+    """載入並快取 CREPE 模型（同一容量的權重只載入一次）"""
+    import crepe.core
+    return crepe.core.build_and_load_model(model_capacity)
+
+
+def _predict_pitch_batched(
+    audio_mono: np.ndarray,
+    sample_rate: int,
+    model_capacity: str,
+    step_size: int,
+    viterbi: bool
+):
+    """自行切框後以大批次執行 CREPE 推論
+
+    crepe.predict 的預設路徑使用 Keras 預設批次大小（32），GPU 上
+    每 500 個 frame 會拆成十幾次 kernel 啟動。這裡手動切出
+    (n_frames, 1024) 的輸入並以 batch_size=512 一次推論。
+    """
+    import crepe.core
+
+    # CREPE 固定以 16 kHz 輸入
+    if sample_rate != _CREPE_SAMPLE_RATE:
+        audio_mono = librosa.resample(
+            audio_mono, orig_sr=sample_rate, target_sr=_CREPE_SAMPLE_RATE
+        )
+
+    # 前後補零讓每個 frame 以其時間點為中心（對齊 crepe.predict 的輸出）
+    hop_length = int(_CREPE_SAMPLE_RATE * step_size / 1000)
+    padded = np.pad(audio_mono, _CREPE_FRAME_LENGTH // 2, mode="constant")
+    frames = librosa.util.frame(
+        padded,
+        frame_length=_CREPE_FRAME_LENGTH,
+        hop_length=hop_length
+    ).T.copy()
+
+    # 逐 frame 正規化（零均值、單位標準差），與 CREPE 的前處理一致
+    frames -= frames.mean(axis=1, keepdims=True)
+    std = frames.std(axis=1, keepdims=True)
+    np.clip(std, 1e-8, None, out=std)
+    frames /= std
+
+    model = _get_crepe_model(model_capacity)
+    activation = model.predict(frames, batch_size=512, verbose=0)
+
+    confidence = activation.max(axis=1)
+    if viterbi:
+        # Viterbi 解碼較平滑但是 CPU 逐格序列運算，預設關閉
+        cents = crepe.core.to_viterbi_cents(activation)
+    else:
+        cents = crepe.core.to_local_average_cents(activation)
+
+    frequency = 10 * 2 ** (cents / 1200)
+    frequency[np.isnan(frequency)] = 0
+    time = np.arange(len(confidence)) * step_size / 1000
+
+    return time, frequency, confidence
+
+
 def detect_pitch(
     audio: np.ndarray,
     sample_rate: int,
     model_capacity: str = "medium",
     step_size: int = 10,
-    confidence_threshold: float = 0.5
+    confidence_threshold: float = 0.5,
+    viterbi: bool = False
 ) -> PitchData:
     """
     使用 CREPE 偵測音訊中的音高
@@ -36,29 +104,30 @@ def detect_pitch(
         model_capacity: CREPE 模型大小，可選 "tiny", "small", "medium", "large", "full"
         step_size: 音高偵測的時間步長（毫秒）
         confidence_threshold: 信心度閾值，低於此值的音高將被標記為無效
+        viterbi: 是否使用 Viterbi 解碼（較平滑但為 CPU 序列運算，較慢）
 
     回傳:
         PitchData: 包含時間、頻率、信心度的資料結構
     """
     print(f"使用 CREPE 模型 ({model_capacity}) 偵測音高...")
 
-    # 確保音訊為單聲道
+    # 確保音訊為單聲道（指定 dtype 避免悄悄升成 float64）
     if audio.ndim == 2:
         # 取平均轉為單聲道
-        audio_mono = np.mean(audio, axis=0)
+        audio_mono = np.mean(audio, axis=0, dtype=np.float32)
     else:
         audio_mono = audio
 
     # 確保音訊為 float32
-    audio_mono = audio_mono.astype(np.float32)
+    audio_mono = audio_mono.astype(np.float32, copy=False)
 
-    # 使用 CREPE 偵測音高
-    time, frequency, confidence, _ = crepe.predict(
+    # 使用 CREPE 偵測音高（自行切框 + 大批次推論）
+    time, frequency, confidence = _predict_pitch_batched(
         audio_mono,
         sample_rate,
         model_capacity=model_capacity,
         step_size=step_size,
-        viterbi=True  # 使用 Viterbi 解碼獲得更平滑的結果
+        viterbi=viterbi
     )
 
     # 將低信心度的頻率設為 0（表示無效）
@@ -75,6 +144,22 @@ def detect_pitch(
     )
 
 
+@njit(cache=True, parallel=True, fastmath=True)
+def _frequency_to_midi_kernel(frequency: np.ndarray, out: np.ndarray) -> None:
+    """單次掃描的頻率轉 MIDI 核心（無效頻率寫入 0）"""
+    for i in prange(frequency.size):
+        f = frequency[i]
+        out[i] = 0.0 if f <= 0 else 69.0 + 12.0 * np.log2(f / 440.0)
+
+
+@njit(cache=True, parallel=True, fastmath=True)
+def _midi_to_frequency_kernel(midi: np.ndarray, out: np.ndarray) -> None:
+    """單次掃描的 MIDI 轉頻率核心（無效音符寫入 0）"""
+    for i in prange(midi.size):
+        m = midi[i]
+        out[i] = 0.0 if m <= 0 else 440.0 * 2.0 ** ((m - 69.0) / 12.0)
+
+
 def frequency_to_midi(frequency: np.ndarray) -> np.ndarray:
     """
     將頻率轉換為 MIDI 音符編號
@@ -85,9 +170,9 @@ def frequency_to_midi(frequency: np.ndarray) -> np.ndarray:
     回傳:
         MIDI 音符編號陣列，無效頻率對應 0
     """
-    midi = np.zeros_like(frequency)
-    valid = frequency > 0
-    midi[valid] = 69 + 12 * np.log2(frequency[valid] / 440.0)
+    frequency = np.ascontiguousarray(frequency)
+    midi = np.empty(frequency.shape, dtype=np.float32)
+    _frequency_to_midi_kernel(frequency.ravel(), midi.ravel())
     return midi
 
 
@@ -101,7 +186,7 @@ def midi_to_frequency(midi: np.ndarray) -> np.ndarray:
     回傳:
         頻率陣列（Hz），無效音符對應 0
     """
-    frequency = np.zeros_like(midi, dtype=np.float32)
-    valid = midi > 0
-    frequency[valid] = 440.0 * (2 ** ((midi[valid] - 69) / 12))
+    midi = np.ascontiguousarray(midi)
+    frequency = np.empty(midi.shape, dtype=np.float32)
+    _midi_to_frequency_kernel(midi.ravel(), frequency.ravel())
     return frequency
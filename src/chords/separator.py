@@ -4,6 +4,7 @@
 使用 Demucs v4 將音訊分離成人聲與伴奏
 """
 
+import functools
 from dataclasses import dataclass
 from typing import Tuple
 
@@ -12,6 +13,13 @@ import torch
 from demucs.apply import apply_model
 from demucs.pretrained import get_model
 
+# 檢查 torchaudio 是否可用（裝置上的重新取樣）
+try:
+    import torchaudio
+    _TORCHAUDIO_AVAILABLE = True
+except Exception:
+    _TORCHAUDIO_AVAILABLE = False
+
 
 @dataclass
 class SeparatedAudio:
@@ -21,6 +29,137 @@ class SeparatedAudio:
     sample_rate: int
 
 
+# 分段處理時段與段之間的重疊秒數（重疊區以交叉淡化合併）
+_CHUNK_OVERLAP_SECONDS = 1.0
+
+
+@functools.lru_cache(maxsize=4)
+def _get_demucs_model(model_name: str, device_str: str):
+    """載入並快取 Demucs 模型（同一模型與裝置只載入、上傳一次）"""
+    model = get_model(model_name)
+    model.to(device_str)
+    model.eval()
+    return model
+
+
+def _resample_tensor(
+    audio_tensor: torch.Tensor,
+    orig_sr: int,
+    target_sr: int,
+    device: torch.device
+) -> torch.Tensor:
+    """在指定裝置上重新取樣 (channels, samples) 張量"""
+    if _TORCHAUDIO_AVAILABLE:
+        resampler = torchaudio.transforms.Resample(orig_sr, target_sr).to(device)
+        with torch.no_grad():
+            return resampler(audio_tensor.to(device))
+
+    # fallback: librosa 逐聲道重新取樣（CPU）
+    import librosa
+    audio = audio_tensor.cpu().numpy()
+    resampled = np.array([
+        librosa.resample(audio[ch], orig_sr=orig_sr, target_sr=target_sr)
+        for ch in range(audio.shape[0])
+    ])
+    return torch.from_numpy(resampled).float().to(device)
+
+
+def _run_model(
+    model,
+    audio_tensor: torch.Tensor,
+    device: torch.device
+) -> torch.Tensor:
+    """對單一 (1, channels, samples) 張量執行 Demucs"""
+    with torch.no_grad():
+        if device.type == "cuda":
+            # GPU 上以 FP16 autocast 執行：記憶體流量減半並使用 Tensor Core，
+            # 權重保持 FP32 以維持數值穩定；輸出轉回 FP32 再做後續加總
+            with torch.autocast("cuda", dtype=torch.float16):
+                sources = apply_model(model, audio_tensor, device=device)
+            return sources.float()
+        return apply_model(model, audio_tensor, device=device)
+
+
+def _apply_model_chunked(
+    model,
+    audio_tensor: torch.Tensor,
+    device: torch.device
+) -> torch.Tensor:
+    """分段執行 Demucs 並以重疊交叉淡化合併結果
+
+    一次送入整首歌會讓中間 STFT 緩衝的 VRAM 用量隨曲長成長。
+    長曲目改以約一個 model.segment 的區段、1 秒重疊逐段處理：
+    GPU 記憶體用量與曲長無關，且 pinned memory + non_blocking
+    讓資料上傳與運算重疊。
+
+    參數:
+        model: Demucs 模型
+        audio_tensor: (channels, samples) 音訊張量
+        device: 運算裝置
+
+    回傳:
+        (1, n_sources, channels, samples) 的分離結果張量
+    """
+    sample_rate = model.samplerate
+    segment = getattr(model, "segment", None)
+    chunk_samples = int(float(segment or 10.0) * sample_rate)
+    # 重疊不可超過段長的一半，否則相鄰段無法前進
+    overlap_samples = min(
+        int(_CHUNK_OVERLAP_SECONDS * sample_rate),
+        chunk_samples // 2
+    )
+    total_samples = audio_tensor.shape[-1]
+
+    # 短曲目直接一次處理
+    if total_samples <= chunk_samples:
+        return _run_model(model, audio_tensor.to(device).unsqueeze(0), device)
+
+    # 長曲目：音訊已在裝置上就直接切片，避免下載再重新上傳的往返；
+    # 還在 CPU 上才放進 pinned 緩衝，逐段非同步上傳
+    if audio_tensor.device == device:
+        audio_source = audio_tensor
+    else:
+        audio_source = audio_tensor.cpu()
+        if device.type == "cuda":
+            audio_source = audio_source.pin_memory()
+
+    n_sources = len(model.sources)
+    channels = audio_tensor.shape[0]
+    output = np.zeros((n_sources, channels, total_samples), dtype=np.float32)
+    weight = np.zeros(total_samples, dtype=np.float32)
+
+    # 重疊區的漸入權重（Hann 窗前半段）
+    fade_in = np.hanning(2 * overlap_samples)[:overlap_samples].astype(np.float32)
+
+    step = chunk_samples - overlap_samples
+    start = 0
+    while start < total_samples:
+        end = min(start + chunk_samples, total_samples)
+        chunk = audio_source[..., start:end]
+        if chunk.device != device:
+            chunk = chunk.to(device, non_blocking=True)
+        result = _run_model(model, chunk.unsqueeze(0), device)[0].cpu().numpy()
+
+        # 段首/段尾在重疊區做交叉淡化
+        length = end - start
+        chunk_weight = np.ones(length, dtype=np.float32)
+        ramp = min(overlap_samples, length)
+        if start > 0:
+            chunk_weight[:ramp] = fade_in[:ramp]
+        if end < total_samples:
+            chunk_weight[length - ramp:] = fade_in[:ramp][::-1]
+
+        output[..., start:end] += result * chunk_weight
+        weight[start:end] += chunk_weight
+
+        if end >= total_samples:
+            break
+        start += step
+
+    output /= np.clip(weight, 1e-8, None)
+    return torch.from_numpy(output).unsqueeze(0)
+
+
 def get_device() -> torch.device:
     """取得可用的運算裝置（優先使用 GPU）"""
     if torch.cuda.is_available():
@@ -47,10 +186,9 @@ def separate_audio(
     device = get_device()
     print(f"使用裝置: {device}")
 
-    # 載入 Demucs 模型
+    # 載入 Demucs 模型（已載入過則直接使用快取）
     print(f"載入 Demucs 模型: {model_name}...")
-    model = get_model(model_name)
-    model.to(device)
+    model = _get_demucs_model(model_name, str(device))
 
     # 確保音訊格式正確 (channels, samples)
     if audio.ndim == 1:
@@ -58,55 +196,45 @@ def separate_audio(
     elif audio.ndim == 2 and audio.shape[0] > audio.shape[1]:
         audio = audio.T  # 轉置成 (channels, samples)
 
-    # 如果取樣率不符合模型需求，需要重新取樣
+    # 轉換為 PyTorch tensor 並移至運算裝置
+    audio_tensor = torch.from_numpy(audio).float().to(device)
+
+    # 如果取樣率不符合模型需求，直接在裝置上重新取樣
+    original_sr = sample_rate
     if sample_rate != model.samplerate:
-        import librosa
-        audio_resampled = np.array([
-            librosa.resample(audio[ch], orig_sr=sample_rate, target_sr=model.samplerate)
-            for ch in range(audio.shape[0])
-        ])
-        audio = audio_resampled
-        original_sr = sample_rate
+        audio_tensor = _resample_tensor(
+            audio_tensor, sample_rate, model.samplerate, device
+        )
         sample_rate = model.samplerate
-    else:
-        original_sr = sample_rate
-
-    # 轉換為 PyTorch tensor
-    audio_tensor = torch.from_numpy(audio).float().unsqueeze(0)  # (1, channels, samples)
-    audio_tensor = audio_tensor.to(device)
 
-    # 執行分離
+    # 執行分離（長曲目分段處理，GPU 記憶體用量與曲長無關）
     print("正在分離音源...")
-    with torch.no_grad():
-        sources = apply_model(model, audio_tensor, device=device)
+    sources = _apply_model_chunked(model, audio_tensor, device)
 
     # Demucs htdemucs 輸出順序: drums, bass, other, vocals
     # 取得各音軌索引
     source_names = model.sources
     vocals_idx = source_names.index("vocals")
+    non_vocal_idx = [i for i, name in enumerate(source_names) if name != "vocals"]
 
-    # 提取人聲
-    vocals = sources[0, vocals_idx].cpu().numpy()
+    # 在裝置上完成「伴奏 = 所有非人聲音軌的總和」，
+    # 人聲與伴奏各只需一次傳輸回主記憶體
+    vocals_tensor = sources[0, vocals_idx]
+    accompaniment_tensor = sources[0, non_vocal_idx].sum(dim=0)
 
-    # 伴奏 = 所有非人聲音軌的總和
-    accompaniment = np.zeros_like(vocals)
-    for i, name in enumerate(source_names):
-        if name != "vocals":
-            accompaniment += sources[0, i].cpu().numpy()
-
-    # 如果需要，重新取樣回原始取樣率
+    # 如果需要，在裝置上重新取樣回原始取樣率
     if original_sr != sample_rate:
-        import librosa
-        vocals = np.array([
-            librosa.resample(vocals[ch], orig_sr=sample_rate, target_sr=original_sr)
-            for ch in range(vocals.shape[0])
-        ])
-        accompaniment = np.array([
-            librosa.resample(accompaniment[ch], orig_sr=sample_rate, target_sr=original_sr)
-            for ch in range(accompaniment.shape[0])
-        ])
+        vocals_tensor = _resample_tensor(
+            vocals_tensor, sample_rate, original_sr, device
+        )
+        accompaniment_tensor = _resample_tensor(
+            accompaniment_tensor, sample_rate, original_sr, device
+        )
         sample_rate = original_sr
 
+    vocals = vocals_tensor.cpu().numpy()
+    accompaniment = accompaniment_tensor.cpu().numpy()
+
     print("音源分離完成！")
 
     return SeparatedAudio(
@@ -26,6 +26,36 @@ class TestAnalyzer:
         # 小調音階有 7 個音
         assert len(MINOR_SCALE_INTERVALS) == 7
 
+    def test_harmony_intervals_array(self):
+        """測試向量化和聲音程查表"""
+        from chords.analyzer import (
+            KeyInfo,
+            get_harmony_intervals,
+            get_harmony_intervals_array,
+        )
+
+        key_info = KeyInfo(
+            root="C",
+            root_index=0,
+            mode="major",
+            confidence=1.0,
+            scale_notes=[]
+        )
+        melody_midi = np.arange(60, 72)
+
+        # 三度：與逐音版本結果一致
+        thirds = get_harmony_intervals_array(key_info, melody_midi)
+        expected = [
+            get_harmony_intervals(key_info, int(m)) for m in melody_midi
+        ]
+        assert thirds.tolist() == expected
+
+        # 五度永遠是 7 個半音
+        fifths = get_harmony_intervals_array(
+            key_info, melody_midi, harmony_type="fifth"
+        )
+        assert np.all(fifths == 7)
+
 
 class TestPitch:
     """音高偵測模組測試"""